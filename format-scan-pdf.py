@@ -5,7 +5,7 @@
 # All Rights Reserved - See License
 #
 
-# USAGE: format-scan-pdf.py <source.pdf> <destination.pdf>
+# USAGE: format-scan-pdf.py [--runfile <file.run>] [--workdir <dir>] <source.pdf> <destination.pdf>
 
 #
 # DEPENDENCIES (all must be in your PATH):
@@ -14,15 +14,21 @@
 #   exiftool -> Available on Ubuntu in the libimage-exiftool-perl package
 #   gm --> Available on Ubuntu in the graphicsmagick package
 #   mutool --> Available on Ubuntu in the mupdf-tools package
+#   numpy --> Available on Ubuntu in the python3-numpy package
 #   ocrmypdf --> Available on Ubuntu in the ocrmypdf package
 #   parallel --> Available on Ubuntu in the parallel package
 #   pdftk --> Available on Ubuntu in the pdftk package
+#   pdfimages --> Available on Ubuntu in the poppler-utils package
 #   pdftoppm --> Available on Ubuntu in the poppler-utils package
+#   pikepdf --> Available on Ubuntu in the python3-pikepdf package
+#   pngquant --> Available on Ubuntu in the pngquant package
 #   prompt_toolkit --> Available on Ubuntu in the python3-prompt-toolkit package
 #   qpdf - Available on Ubuntu in the qpdf package
 #
 
 import argparse
+import glob
+import json
 import os
 import os.path
 import re
@@ -31,13 +37,21 @@ import subprocess
 import sys
 import tempfile
 
+import numpy
+import pikepdf
 from prompt_toolkit.shortcuts import radiolist_dialog, yes_no_dialog
 
+BLANK_THRESHOLD = 0.1  # Percent of a page that must be ink for it not to be blank
+TEXT_MAX_INK = 10  # Percent of a page that can be ink for it to be made black and white as text
+OCR_PAGES_PER_CPU = 4  # Pages per CPU OCRed (and checkpointed) at a time
+WORKDIR_STAGES = ("remove_blank", "remove_hidden", "crop", "split", "deskew", "ocr", "optimize")  # Scratch dirs
+
 
 def parse_arguments():
     """Get arguments from command line."""
     parser = argparse.ArgumentParser(description="Make scanned PDFs more usable")
     parser.add_argument('--runfile', help="Run (config) filename")
+    parser.add_argument('--workdir', help="Working directory (an interrupted run resumes from it)")
     parser.add_argument('infile', help="Input filename")
     parser.add_argument('outfile', help="Output filename")
 
@@ -54,6 +68,115 @@ def parse_arguments():
     return args, runfile
 
 
+def remove_blank(fn_in, fn_out, tmpdir, runfile):
+    """Prompt user to remove blank pages and, if so, remove them."""
+    if "remove_blank" in runfile:
+        if runfile["remove_blank"] in ("no", "yes"):
+            choice = runfile["remove_blank"]
+        elif re.match(r"^\d+(\.\d+)?$", runfile["remove_blank"]):
+            choice = runfile["remove_blank"]
+        else:
+            choice = "no"
+    elif len(runfile) > 0:
+        # Run files from before this option existed.
+        choice = "no"
+    else:
+        choice = radiolist_dialog(
+            title="Remove Blank Pages",
+            text="Do you want to remove blank pages (such as the backs of duplex scans)?",
+            values=[
+                ("no", "No"),
+                ("yes", "Yes"),
+            ],
+        ).run()
+
+    if choice is None:
+        print("Exiting without changes.")
+        sys.exit()
+    elif choice == "no":
+        shutil.copy(fn_in, fn_out)
+        return
+
+    if choice == "yes":
+        threshold = BLANK_THRESHOLD
+    else:
+        threshold = float(choice)
+
+    coverage = ink_coverage(page_thumbnails(fn_in, tmpdir))
+    keep = [str(i + 1) for i in numpy.flatnonzero(coverage >= threshold)]
+
+    if len(keep) == 0 or len(keep) == len(coverage):
+        shutil.copy(fn_in, fn_out)
+    else:
+        print(f"Removing {len(coverage) - len(keep)} blank page(s)")
+        subprocess.check_call(["pdftk", fn_in, "cat"] + keep + ["output", fn_out])
+
+
+def page_thumbnails(fn_in, tmpdir):
+    """Greyscale thumbnails of every page, as a pages x height x width array."""
+    # Low resolution thumbnails, brought to the same size, are plenty to
+    # tell blank pages from text and can be checked all at once.
+    base = os.path.join(tmpdir, "thumbs")
+    width, height = 170, 220
+    subprocess.check_call(["pdftoppm", "-gray", "-scale-to-x", str(width), "-scale-to-y", str(height),
+                           fn_in, base])
+    pages = [read_pgm(fn, width, height) for fn in sorted(glob.glob(f"{base}-*.pgm"))]
+    thumbs = numpy.stack(pages)
+
+    # Ignore the outer 5% (scanner shadows, punch holes).
+    return thumbs[:, height // 20:-(height // 20), width // 20:-(width // 20)]
+
+
+def paper_colour(thumbs):
+    """The paper colour of each page."""
+    # Not the median: a picture covering most of the page would pass for
+    # the paper.  Paper is (nearly) the lightest thing on a page.
+    return numpy.percentile(thumbs, 90, axis=(1, 2))
+
+
+def ink_coverage(thumbs):
+    """Percentage of each page that is ink: anything clearly darker than
+    the page's own paper colour."""
+    paper = paper_colour(thumbs)[:, numpy.newaxis, numpy.newaxis]
+    return (thumbs < paper - 48).mean(axis=(1, 2)) * 100
+
+
+def read_pgm(fn, width, height):
+    """Read a binary PGM image as a height x width array of 0-255 values."""
+    with open(fn, "rb") as f:
+        data = f.read()
+
+    # Header: magic number, width, height and maxval, separated by
+    # whitespace (and possibly comments), then a single whitespace byte.
+    fields = []
+    pos = 0
+    while len(fields) < 4:
+        if data[pos:pos + 1] == b"#":
+            pos = data.index(b"\n", pos)
+        elif data[pos:pos + 1].isspace():
+            pos += 1
+        else:
+            match = re.match(rb"\S+", data[pos:pos + 32])
+            fields.append(match.group(0))
+            pos += len(match.group(0))
+    if fields[0] != b"P5":
+        raise ValueError(f"{fn} is not a binary PGM file")
+    img_width, img_height, maxval = int(fields[1]), int(fields[2]), int(fields[3])
+
+    dtype = numpy.uint8 if maxval < 256 else numpy.dtype(">u2")
+    img = numpy.frombuffer(data, dtype=dtype, count=img_width * img_height, offset=pos + 1)
+    img = img.reshape(img_height, img_width).astype(numpy.int32) * 255 // maxval
+
+    # pdftoppm rounds the size up, and swaps it for pages rotated by 90 or
+    # 270 degrees; ink coverage doesn't care about either, so turn
+    # landscape pages upright and resample to the requested size.
+    if img_width > img_height:
+        img = img.T
+    rows = numpy.linspace(0, img.shape[0] - 1, height).round().astype(int)
+    cols = numpy.linspace(0, img.shape[1] - 1, width).round().astype(int)
+    return img[rows][:, cols].astype(numpy.int16)
+
+
 def rotate(fn_in, fn_out, runfile):
     """Prompt user for rotation info and rotate document."""
     if "rotate" in runfile:
@@ -330,7 +453,7 @@ def remove_hidden(fn_in, fn_out, tmpdir, runfile):
         return True
 
 
-def ocr(fn_in, fn_out, runfile):
+def ocr(fn_in, fn_out, tmpdir, runfile):
     """Prompt user to determine if they want OCR and, if so, OCR it."""
     if "ocr" in runfile:
         if runfile["ocr"] == "yes":
@@ -345,66 +468,349 @@ def ocr(fn_in, fn_out, runfile):
 
     if not choice:
         shutil.copy(fn_in, fn_out)
-    else:
+        return
+
+    # ocrmypdf works on one page per CPU at a time, so a chunk of a few
+    # pages per CPU keeps them all busy.
+    chunk_pages = OCR_PAGES_PER_CPU * len(os.sched_getaffinity(0))
+    pages = page_count(fn_in)
+    if pages <= chunk_pages:
         subprocess.check_call(["ocrmypdf", "--force-ocr", fn_in, fn_out])
+        return
+
+    # OCR a range of pages at a time and keep each finished range in
+    # tmpdir, so an interrupted run (with --workdir) only redoes the range
+    # it was working on.  The ranges are plain PDFs; the PDF/A conversion
+    # is done once, on the merged document.
+    chunks = []
+    for first in range(1, pages + 1, chunk_pages):
+        last = min(first + chunk_pages - 1, pages)
+        fn_chunk = os.path.join(tmpdir, f"ocr-{first:05d}-{last:05d}.pdf")
+        if not os.path.exists(fn_chunk):
+            fn_pages = os.path.join(tmpdir, "pages.pdf")
+            run_qpdf([fn_in, "--pages", fn_in, f"{first}-{last}", "--", fn_pages])
+            subprocess.check_call(["ocrmypdf", "--force-ocr", "--output-type", "pdf",
+                                   fn_pages, f"{fn_chunk}.tmp"])
+            os.replace(f"{fn_chunk}.tmp", fn_chunk)
+        chunks.append(fn_chunk)
+
+    fn_merged = os.path.join(tmpdir, "merged.pdf")
+    args = [fn_in, "--pages"]
+    for fn_chunk in chunks:
+        args += [fn_chunk, "1-z"]
+    run_qpdf(args + ["--", fn_merged])
+
+    # Every page already has its text layer (pages where none was found
+    # aren't tried again), so this only does the PDF/A conversion.
+    subprocess.check_call(["ocrmypdf", "--skip-text", "--tesseract-timeout", "0",
+                           fn_merged, fn_out])
+
+
+def page_count(fn_in):
+    """Number of pages in a PDF file."""
+    return int(subprocess.check_output(["qpdf", "--show-npages", fn_in]).decode().strip())
+
+
+def run_qpdf(args):
+    """Run qpdf, which exits with 3 when it succeeds with warnings."""
+    returncode = subprocess.call(["qpdf"] + args)
+    if returncode not in (0, 3):
+        raise subprocess.CalledProcessError(returncode, "qpdf")
+
+
+def optimize(fn_in, fn_out, tmpdir, runfile):
+    """Prompt user for an output size optimization profile and optimize it."""
+    if "optimize" in runfile:
+        if runfile["optimize"] not in ("none", "fast", "balanced", "smallest"):
+            choice = "none"
+        else:
+            choice = runfile["optimize"]
+    elif len(runfile) > 0:
+        # Run files from before this option existed.
+        choice = "none"
+    else:
+        choice = radiolist_dialog(
+            title="Optimize",
+            text="Do you want to make the output file smaller?\n" +
+                "(the smaller options recompress the page images and lose some image quality)",
+            values=[
+                ("none", "No"),
+                ("fast", "Fast (lossless, only restructures the file)"),
+                ("balanced", "Balanced (text pages to black and white, recompress images)"),
+                ("smallest", "Smallest (aggressively recompress images)"),
+            ],
+        ).run()
 
+    if choice is None:
+        print("Exiting without changes.")
+        sys.exit()
+    elif choice == "none":
+        shutil.copy(fn_in, fn_out)
+        return False
 
-def restore_metadata(fn_in, fn_out):
-    """Reset metadata in PDF file."""
-    author = subprocess.check_output(["exiftool", fn_in, "-Author", "-s"]).decode()
-    publisher = subprocess.check_output(["exiftool", fn_in, "-Publisher", "-s"]).decode()
-    title = subprocess.check_output(["exiftool", fn_in, "-Title", "-s"]).decode()
+    if choice == "fast":
+        fn_images = fn_in
+    else:
+        # Text pages become black and white first, which is far smaller
+        # than any JPEG of them.
+        fn_bilevel = os.path.join(tmpdir, "bilevel.pdf")
+        bilevel_text_pages(fn_in, fn_bilevel, tmpdir)
+
+        # With no OCR time allowed, ocrmypdf only runs its optimizer, which
+        # re-encodes the remaining (JPEG) page images at the given quality.
+        # The pipeline writes them at quality 75, so anything less than
+        # that is needed to make them smaller.
+        fn_images = f"{fn_out}.images.pdf"
+        if choice == "balanced":
+            quality = ["--optimize", "2", "--jpeg-quality", "60", "--png-quality", "70"]
+        else:
+            quality = ["--optimize", "3", "--jpeg-quality", "40", "--png-quality", "50"]
+        subprocess.check_call(["ocrmypdf", "--skip-text", "--tesseract-timeout", "0",
+                               "--output-type", "pdf"] + quality + [fn_bilevel, fn_images])
+
+    args = ["--object-streams=generate", "--compress-streams=y", "--recompress-flate"]
+    if choice == "smallest":
+        args.append("--compression-level=9")
+    run_qpdf(args + [fn_images, fn_out])
+    return True
+
+
+def bilevel_text_pages(fn_in, fn_out, tmpdir):
+    """Replace the scanned image of each page that looks like text with a
+    black and white (CCITT Group 4) version of it, keeping the rest of
+    the page (such as the OCR text layer) as it is."""
+    thumbs = page_thumbnails(fn_in, tmpdir)
+    paper = paper_colour(thumbs)
+    text_pages = numpy.flatnonzero(ink_coverage(thumbs) <= TEXT_MAX_INK)
+
+    pdf = pikepdf.open(fn_in)
+    bilevels = []
+    for i in text_pages:
+        page = pdf.pages[int(i)]
+        images = list(page.images.items())
+        if len(images) != 1:
+            # Not a plain scanned page.
+            continue
+        name, image = images[0]
+        if image.get("/BitsPerComponent") == 1 or "/ImageMask" in image or "/SMask" in image:
+            continue
+
+        # The image itself, rather than a rendering of the page, so the
+        # replacement has exactly the same size and placement.
+        base = os.path.join(tmpdir, f"page-{i + 1:05d}")
+        subprocess.check_call(["pdfimages", "-png", "-f", str(i + 1), "-l", str(i + 1), fn_in, base])
+        level = paper[i] * 2 / 3 * 100 / 255  # Percent, as gm wants it
+        subprocess.check_call(["gm", "convert", f"{base}-000.png", "-colorspace", "gray",
+                               "-threshold", f"{level:.0f}%", "-type", "bilevel",
+                               "-compress", "Group4", f"{base}.pdf"])
+        os.remove(f"{base}-000.png")
+
+        # The source of copy_foreign() has to stay open until the save.
+        bilevel = pikepdf.open(f"{base}.pdf")
+        bilevels.append(bilevel)
+        page.Resources.XObject[name] = pdf.copy_foreign(next(iter(bilevel.pages[0].images.values())))
+
+    if len(bilevels) > 0:
+        print(f"Converting {len(bilevels)} text page(s) to black and white")
+    pdf.save(fn_out)
+    pdf.close()
+    for bilevel in bilevels:
+        bilevel.close()
+
+
+def read_metadata(fn_in):
+    """Read the metadata we preserve from a PDF file (in one exiftool run)."""
+    output = subprocess.check_output(["exiftool", "-json", "-Author", "-Publisher", "-Title", fn_in])
+    # exiftool leaves number-like values unquoted; keep them verbatim
+    # (a Title of "1.50" must not come back as 1.5).
+    tags = json.loads(output.decode(), parse_float=str, parse_int=str)[0]
+    return {k: str(tags.get(k, "")) for k in ("Author", "Publisher", "Title")}
+
+
+def restore_metadata(fn_orig, fn_in, fn_out):
+    """Write fn_in to fn_out with the metadata of fn_orig, in one pass."""
+    metadata = read_metadata(fn_orig)
+    subprocess.check_call(["exiftool"] + [f"-{k}={v}" for k, v in metadata.items()] +
+                          ["-o", fn_out, fn_in])
+
+
+def remove_metadata(fn_in, fn_out, object_streams=False):
+    """Remove metadata in PDF file."""
+    # Building a new document around the pages leaves behind the document
+    # information dictionary and XMP metadata, and the linearized output
+    # has no history of updates to expose what was there.
+    args = ["--empty", "--linearize"]
+    if object_streams:
+        args.append("--object-streams=generate")
+    run_qpdf(args + ["--pages", fn_in, "1-z", "--", fn_out])
 
-    subprocess.check_call(["exiftool", fn_out, f"-Author={author}", "-overwrite_original"])
-    subprocess.check_call(["exiftool", fn_out, f"-Publisher={publisher}", "-overwrite_original"])
-    subprocess.check_call(["exiftool", fn_out, f"-Title={title}", "-overwrite_original"])
 
+def load_checkpoint(workdir):
+    """Read the progress recorded in a working directory by a previous run."""
+    if workdir is None or not os.path.exists(os.path.join(workdir, "state.json")):
+        return {"completed": [], "hide_metadata": False, "optimized": False}
 
-def remove_metadata(fn_in, fn_out):
-    """Remove metadata in PDF file."""
-    subprocess.check_call(["exiftool", fn_in, "-all:all=", "-overwrite_original"])
-    subprocess.call(["qpdf", "--linearize", fn_in, fn_out])
+    with open(os.path.join(workdir, "state.json"), "r") as f:
+        return json.load(f)
 
 
-def main():
-    """Main application function."""
-    args, runfile = parse_arguments()
+def save_state(workdir, state):
+    """Write the progress of this run to the working directory."""
+    fn_state = os.path.join(workdir, "state.json")
+    with open(f"{fn_state}.tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(f"{fn_state}.tmp", fn_state)
 
-    tmpdir = tempfile.TemporaryDirectory()
 
-    fn_in = args.infile
-    fn_tmp1 = os.path.join(tmpdir.name, "work1.pdf")
-    fn_tmp2 = os.path.join(tmpdir.name, "work2.pdf")
-    fn_out = args.outfile
+def save_checkpoint(workdir, state, stage, fn_work):
+    """Record a finished stage (and its output) so a restart can skip it."""
+    if workdir is None:
+        state["completed"].append(stage)
+        return
+
+    if len(state["completed"]) > 0:
+        fn_prev = os.path.join(workdir, f"checkpoint-{state['completed'][-1]}.pdf")
+    else:
+        fn_prev = None
+
+    # Write the PDF before the state file, so a crash in between only
+    # costs a re-run of this stage.  A hard link rather than a copy: the
+    # work file is only ever replaced, never rewritten in place.
+    fn_ckpt = os.path.join(workdir, f"checkpoint-{stage}.pdf")
+    link_file(fn_work, f"{fn_ckpt}.tmp")
+    os.replace(f"{fn_ckpt}.tmp", fn_ckpt)
 
-    shutil.copy(fn_in, fn_tmp1)
+    state["completed"].append(stage)
+    save_state(workdir, state)
 
-    hide_metadata = remove_hidden(fn_tmp1, fn_tmp2, tmpdir.name, runfile)
-    shutil.copy(fn_tmp2, fn_tmp1)
+    if fn_prev is not None and os.path.exists(fn_prev):
+        os.remove(fn_prev)
 
-    rotate(fn_tmp1, fn_tmp2, runfile)
-    shutil.copy(fn_tmp2, fn_tmp1)
 
-    crop(fn_tmp1, fn_tmp2, tmpdir.name, runfile)
-    subprocess.check_call(["pdftk", fn_tmp2, "cat", "output", fn_tmp1])
+def link_file(fn_src, fn_dst):
+    """Make fn_dst a hard link to fn_src, replacing whatever was there."""
+    if os.path.lexists(fn_dst):
+        os.remove(fn_dst)
+    os.link(fn_src, fn_dst)
 
-    split_pages(fn_tmp1, fn_tmp2, tmpdir.name, runfile)
-    shutil.copy(fn_tmp2, fn_tmp1)
 
-    remove_pages(fn_tmp1, fn_tmp2, runfile)
-    shutil.copy(fn_tmp2, fn_tmp1)
+def scratch_dir(workdir, stage):
+    """Return an empty scratch directory for a stage's page images."""
+    path = os.path.join(workdir, stage)
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    return path
 
-    deskew(fn_tmp1, fn_tmp2, tmpdir.name, runfile)
-    shutil.copy(fn_tmp2, fn_tmp1)
 
-    ocr(fn_tmp1, fn_tmp2, runfile)
-    shutil.copy(fn_tmp2, fn_tmp1)
+def clean_workdir(workdir):
+    """Remove what the pipeline put in a working directory (and the
+    directory itself, if that leaves it empty)."""
+    for fn in os.listdir(workdir):
+        path = os.path.join(workdir, fn)
+        if fn in WORKDIR_STAGES and os.path.isdir(path):
+            shutil.rmtree(path)
+        elif re.match(r"^(state\.json|work[12]\.pdf|work2\.pdf\.images\.pdf|checkpoint-[a-z_]+\.pdf)(\.tmp)?$", fn):
+            os.remove(path)
 
-    if hide_metadata:
-        remove_metadata(fn_tmp1, fn_out)
+    if len(os.listdir(workdir)) == 0:
+        os.rmdir(workdir)
+
+
+def main():
+    """Main application function."""
+    args, runfile = parse_arguments()
+
+    if args.workdir is not None:
+        workdir = args.workdir
+        if (os.path.isdir(workdir) and len(os.listdir(workdir)) > 0
+                and not os.path.exists(os.path.join(workdir, "state.json"))):
+            # Don't clean up (delete) someone else's files when we're done.
+            print(f"{workdir} is not empty and is not the working directory of an earlier run.",
+                  file=sys.stderr)
+            sys.exit(1)
+        os.makedirs(workdir, exist_ok=True)
+    else:
+        tmpdir = tempfile.TemporaryDirectory()
+        workdir = tmpdir.name
+
+    fn_in = args.infile
+    fn_tmp1 = os.path.join(workdir, "work1.pdf")
+    fn_tmp2 = os.path.join(workdir, "work2.pdf")
+    fn_out = args.outfile
+    fn_partial = f"{fn_out}.partial"
+
+    state = load_checkpoint(args.workdir)
+    if args.workdir is not None:
+        # Mark the directory as ours before putting anything else in it.
+        save_state(workdir, state)
+    if len(state["completed"]) > 0:
+        print(f"Resuming after stage: {state['completed'][-1]}")
+        link_file(os.path.join(workdir, f"checkpoint-{state['completed'][-1]}.pdf"), fn_tmp1)
     else:
-        shutil.copy(fn_tmp1, fn_out)
-        restore_metadata(fn_in, fn_out)
+        if os.path.lexists(fn_tmp1):
+            os.remove(fn_tmp1)
+        shutil.copy(fn_in, fn_tmp1)
+
+    if "remove_blank" not in state["completed"]:
+        remove_blank(fn_tmp1, fn_tmp2, scratch_dir(workdir, "remove_blank"), runfile)
+        os.replace(fn_tmp2, fn_tmp1)
+        save_checkpoint(args.workdir, state, "remove_blank", fn_tmp1)
+
+    if "remove_hidden" not in state["completed"]:
+        state["hide_metadata"] = remove_hidden(fn_tmp1, fn_tmp2, scratch_dir(workdir, "remove_hidden"), runfile)
+        os.replace(fn_tmp2, fn_tmp1)
+        save_checkpoint(args.workdir, state, "remove_hidden", fn_tmp1)
+
+    if "rotate" not in state["completed"]:
+        rotate(fn_tmp1, fn_tmp2, runfile)
+        os.replace(fn_tmp2, fn_tmp1)
+        save_checkpoint(args.workdir, state, "rotate", fn_tmp1)
+
+    if "crop" not in state["completed"]:
+        crop(fn_tmp1, fn_tmp2, scratch_dir(workdir, "crop"), runfile)
+        subprocess.check_call(["pdftk", fn_tmp2, "cat", "output", f"{fn_tmp1}.tmp"])
+        os.replace(f"{fn_tmp1}.tmp", fn_tmp1)
+        save_checkpoint(args.workdir, state, "crop", fn_tmp1)
+
+    if "split" not in state["completed"]:
+        split_pages(fn_tmp1, fn_tmp2, scratch_dir(workdir, "split"), runfile)
+        os.replace(fn_tmp2, fn_tmp1)
+        save_checkpoint(args.workdir, state, "split", fn_tmp1)
+
+    if "remove_pages" not in state["completed"]:
+        remove_pages(fn_tmp1, fn_tmp2, runfile)
+        os.replace(fn_tmp2, fn_tmp1)
+        save_checkpoint(args.workdir, state, "remove_pages", fn_tmp1)
+
+    if "deskew" not in state["completed"]:
+        deskew(fn_tmp1, fn_tmp2, scratch_dir(workdir, "deskew"), runfile)
+        os.replace(fn_tmp2, fn_tmp1)
+        save_checkpoint(args.workdir, state, "deskew", fn_tmp1)
+
+    if "ocr" not in state["completed"]:
+        # Not a scratch_dir(): it keeps the OCRed page ranges of an
+        # interrupted run.
+        os.makedirs(os.path.join(workdir, "ocr"), exist_ok=True)
+        ocr(fn_tmp1, fn_tmp2, os.path.join(workdir, "ocr"), runfile)
+        os.replace(fn_tmp2, fn_tmp1)
+        save_checkpoint(args.workdir, state, "ocr", fn_tmp1)
+
+    if "optimize" not in state["completed"]:
+        state["optimized"] = optimize(fn_tmp1, fn_tmp2, scratch_dir(workdir, "optimize"), runfile)
+        os.replace(fn_tmp2, fn_tmp1)
+        save_checkpoint(args.workdir, state, "optimize", fn_tmp1)
+
+    # The output only appears under its real name once it is complete.
+    if os.path.exists(fn_partial):
+        os.remove(fn_partial)
+    if state["hide_metadata"]:
+        remove_metadata(fn_tmp1, fn_partial, state["optimized"])
+    else:
+        restore_metadata(fn_in, fn_tmp1, fn_partial)
+    os.replace(fn_partial, fn_out)
+
+    if args.workdir is not None:
+        clean_workdir(workdir)
 
 
 if __name__ == "__main__":
@@ -11,10 +11,33 @@ from flask import Flask
 
 app = Flask(__name__)
 app.config.from_mapping(
+    # Splits the OCR of large documents into shards on the "ocr" queue.
+    # Only worth it with extra machines serving that queue.
+    OCR_SHARDING=False,
     CELERY=dict(
         broker_url="redis://localhost",
         result_backend="redis://localhost",
         task_ignore_result=True,
+        # Jobs are only acknowledged once they finish, so one that was
+        # running when its worker died gets delivered again.
+        task_acks_late=True,
+        task_reject_on_worker_lost=True,
+        worker_prefetch_multiplier=1,
+        # Must be longer than the longest job, or Redis hands a running
+        # job to a second worker.
+        broker_transport_options=dict(visibility_timeout=43_200),  # 12 hours
+        # OCR shards of large documents can be run by workers on other
+        # machines (sharing ~/pdf) that only listen to this queue.  The
+        # reaper has a queue (and worker) of its own, so that it doesn't
+        # wait behind the jobs it is meant to rescue.
+        task_routes={
+            "webapp.task.ocr_shard": {"queue": "ocr"},
+            "webapp.task.reap_jobs": {"queue": "reaper"},
+        },
+        # Picks up jobs whose worker died, and cleans up leftover files.
+        beat_schedule={
+            "reap-jobs": {"task": "webapp.task.reap_jobs", "schedule": 300.0},
+        },
     ),
 )
 celery_app = task.celery_app_init(app)
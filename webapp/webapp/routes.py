@@ -9,6 +9,7 @@ import os
 import re
 import secrets
 
+import gevent
 import redis
 
 from flask import render_template, redirect, request
@@ -16,13 +17,39 @@ from webapp import app, celery_app
 
 import webapp.task as task
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import wrap_file
 
-SAVELOC = os.path.expanduser("~/pdf")
+SAVELOC = task.SAVELOC
 MINSIZE = 1000
 MAXQUEUE = 5
 MBMAX = 200  # 200MB
+DOWNLOAD_CHUNK = 256 * 1024
 app.config["MAX_CONTENT_LENGTH"] = MBMAX * 1024 * 1024
 REDIS = redis.from_url("redis://localhost")
+RATE_BURST = 3  # Documents a client can submit back to back
+RATE_PERIOD = 600  # Seconds for a client to earn another submission
+
+# Token bucket per client, refilled continuously at one token per
+# RATE_PERIOD up to RATE_BURST.  Returns 1 (and takes a token) if the
+# client may submit.
+RATE_LIMIT = REDIS.register_script("""
+local now = redis.call("TIME")
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local capacity = tonumber(ARGV[1])
+local period = tonumber(ARGV[2])
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + (now - ts) / period)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call("HSET", KEYS[1], "tokens", tokens, "ts", now)
+redis.call("EXPIRE", KEYS[1], math.ceil(capacity * period))
+return allowed
+""")
 
 
 @app.route("/")
@@ -30,7 +57,7 @@ REDIS = redis.from_url("redis://localhost")
 @app.route("/index.html")
 def index():
     fields = {}
-    for k in ("remove_metadata", "rotate", "crop", "split", "remove_pages", "deskew", "ocr"):
+    for k in ("remove_blank", "remove_metadata", "rotate", "crop", "split", "remove_pages", "deskew", "ocr", "optimize"):
         fields[k] = ""
 
     return render_template("index.html", errors=[], fields=fields)
@@ -41,7 +68,7 @@ def index():
 @app.route("/index.html", methods=["POST"])
 def index_post():
     fields = {}
-    for k in ("remove_metadata", "rotate", "crop", "split", "remove_pages", "deskew", "ocr"):
+    for k in ("remove_blank", "remove_metadata", "rotate", "crop", "split", "remove_pages", "deskew", "ocr", "optimize"):
         if request.form.get(k) is None:
             fields[k] = ""
         else:
@@ -50,12 +77,13 @@ def index_post():
     if "file" not in request.files:
         return render_template("index.html", errors=["Please select a PDF file to upload"], fields=fields)
 
-    kq = REDIS.get("keysqueued")
-    if kq is not None and int(kq) >= MAXQUEUE:
+    if REDIS.scard("queuedkeys") >= MAXQUEUE:
         return render_template("index.html", errors=["The server is too busy right now.", "Please try later."], fields=fields)
 
     invalid = False
-    if request.form.get("remove_metadata") not in ("no", "yes"):
+    if request.form.get("remove_blank") not in ("no", "yes"):
+        invalid = True
+    elif request.form.get("remove_metadata") not in ("no", "yes"):
         invalid = True
     elif request.form.get("rotate") not in (
         "none",
@@ -96,6 +124,8 @@ def index_post():
         invalid = True
     if request.form.get("ocr") not in ("no", "yes"):
         invalid = True
+    elif request.form.get("optimize") not in ("none", "fast", "balanced", "smallest"):
+        invalid = True
 
     if invalid:
         return render_template(
@@ -109,7 +139,9 @@ def index_post():
 
     f = request.files["file"]
     fn = f.filename
-    f.save(f"{prefix}.pdf")
+    # Copying up to MBMAX from the spooled upload to disk is blocking file
+    # I/O, which would stall every other request of this gevent worker.
+    gevent.get_hub().threadpool.apply(f.save, (f"{prefix}.pdf",))
     filelen = os.stat(f"{prefix}.pdf").st_size
     if filelen == 0:
         return render_template("index.html", errors=["Please select a PDF file to upload"], fields=fields)
@@ -118,7 +150,16 @@ def index_post():
             "index.html", errors=["The file seems too small to be a valid PDF file"], fields=fields
         )
 
+    # Only uploads that would otherwise be accepted use up a token.
+    client = request.remote_addr
+    if not RATE_LIMIT(keys=[f"ratelimit-{client}"], args=[RATE_BURST, RATE_PERIOD]):
+        os.remove(f"{prefix}.pdf")
+        return render_template(
+            "index.html", errors=["You have submitted too many files recently.", "Please try later."], fields=fields
+        )
+
     with open(f"{prefix}.run", "w") as out:
+        out.write(f"remove_blank {request.form.get('remove_blank')}\n")
         out.write(f"remove_metadata {request.form.get('remove_metadata')}\n")
         out.write(f"rotate {request.form.get('rotate')}\n")
         out.write(f"crop {request.form.get('crop')}\n")
@@ -126,18 +167,15 @@ def index_post():
         out.write(f"remove_pages {request.form.get('remove_pages')}\n")
         out.write(f"deskew {request.form.get('deskew')}\n")
         out.write(f"ocr {request.form.get('ocr')}\n")
+        out.write(f"optimize {request.form.get('optimize')}\n")
 
     filepart = os.path.basename(prefix)
 
     REDIS.set(f"status-{filepart}", "queued")
     REDIS.set(f"filename-{filepart}", fn)
-    k = REDIS.get("lastkey")
-    if k is not None:
-        REDIS.set(f"after-{filepart}", k)
-    REDIS.incr("keysqueued")
-    REDIS.set("lastkey", filepart)
+    REDIS.sadd("queuedkeys", filepart)
 
-    task.process_pdf.delay(f"{prefix}")
+    task.enqueue_pdf(prefix, client)
 
     return redirect(f"waiting.html?key={filepart}")
 
@@ -240,25 +278,16 @@ def download():
     else:
         fn = fn.decode("utf-8")
 
-    REDIS.set(f"after-{key}", 0)
     REDIS.pexpire(f"status-{key}", 3_600_000)  # One hour
     REDIS.delete(f"status-{key}")
-    REDIS.pexpire(f"after-{key}", 3_600_000)  # One hour
-    REDIS.delete(f"after-{key}")
     REDIS.pexpire(f"filename-{key}", 3_600_000)  # One hour
     REDIS.delete(f"filename-{key}")
 
     if status is None and os.path.exists(f"{SAVELOC}/{key}-processed.pdf"):
-        return app.response_class(
-            stream_and_remove_file(key),
-            headers={"Content-Disposition": f"attachment; filename={fn}"},
-        )
+        return download_response(key, fn)
 
     if status == "done" and os.path.exists(f"{SAVELOC}/{key}-processed.pdf"):
-        return app.response_class(
-            stream_and_remove_file(key),
-            headers={"Content-Disposition": f"attachment; filename={fn}"},
-        )
+        return download_response(key, fn)
 
     return render_template(
         "error.html",
@@ -276,6 +305,21 @@ def error_413(e):
     )
 
 
+def download_response(key, fn):
+    fh = stream_and_remove_file(key)
+    # Hand the file to the server in large blocks (rather than iterating
+    # it by "lines"), so a slow client only ever costs a gevent greenlet.
+    return app.response_class(
+        wrap_file(request.environ, fh, buffer_size=DOWNLOAD_CHUNK),
+        mimetype="application/pdf",
+        direct_passthrough=True,
+        headers={
+            "Content-Disposition": f"attachment; filename={fn}",
+            "Content-Length": os.fstat(fh.fileno()).st_size,
+        },
+    )
+
+
 def stream_and_remove_file(key):
     ourfn = f"{SAVELOC}/{key}-processed.pdf"
     fh = open(ourfn, "rb")
@@ -288,15 +332,9 @@ def get_temp_prefix():
 
 
 def get_pending_requests(key):
-    cnt = 0
-    k = key
-    while k is not None:
-        k = REDIS.get(f"after-{k}")
-        if k is not None:
-            k = k.decode("utf-8")
-        if k is not None and k != "0":
-            cnt += 1
-
-    if cnt < 1:
-        cnt = 1
-    return cnt - 1
+    # Jobs are run in fair queue order, so count the queued jobs ahead of
+    # this one plus the ones currently running.
+    rank = REDIS.zrank("fairqueue", key)
+    if rank is None:
+        return 0
+    return rank + REDIS.hlen("fairrunning")
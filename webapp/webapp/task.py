@@ -5,14 +5,72 @@
 # All Rights Reserved - See License
 #
 
+import glob
 import os
+import re
 import redis
+import shutil
+import socket
 import subprocess
+import time
 
 from celery import Celery, Task, shared_task
-from flask import Flask
+from celery.signals import celeryd_init, worker_ready
+from flask import Flask, current_app
 
+SAVELOC = os.path.expanduser("~/pdf")
 REDIS = redis.from_url("redis://localhost")
+DOCKER_IMAGE = "jmaslak/format-scan-pdf"
+OCR_SHARD_PAGES = 25  # Smallest shard worth the overhead of its own container
+OCR_MAX_SHARDS = 16
+LEASE_SECS = 300  # A job is considered abandoned 5 minutes after its worker stops renewing it
+ORPHAN_SECS = 3600  # Leftover files without a job are removed after an hour
+MAX_ATTEMPTS = 3  # A job that kills its worker this many times is given up on
+SHARD_DEADLINE_SECS = 43_200  # A sharded job that hasn't been merged after 12 hours is given up on
+
+# Owner recorded in the leases this worker takes (its Celery node name,
+# once the worker has started).
+WORKER_NAME = socket.gethostname()
+
+# Weighted fair queueing: each job gets a virtual finish time one unit
+# (divided by its client's weight, from the "fairweights" hash) after the
+# later of the current virtual time and its client's previous job, and
+# jobs run in finish time order.  A client with many jobs queued thus
+# takes turns with everyone else instead of going first.
+FAIR_ENQUEUE = REDIS.register_script("""
+local weight = tonumber(redis.call("HGET", KEYS[3], ARGV[2])) or 1
+local vtime = tonumber(redis.call("GET", KEYS[4])) or 0
+local last = tonumber(redis.call("HGET", KEYS[2], ARGV[2])) or 0
+local finish = math.max(vtime, last) + 1 / weight
+redis.call("HSET", KEYS[2], ARGV[2], finish)
+redis.call("HSET", KEYS[5], ARGV[1], ARGV[2])
+redis.call("ZADD", KEYS[1], finish, ARGV[1])
+""")
+
+# Hands the next job to a Celery task (or the job it already had, if the
+# task is being redelivered after a crash).
+FAIR_CLAIM = REDIS.register_script("""
+local running = redis.call("HGET", KEYS[4], ARGV[1])
+if running then
+    return running
+end
+local job = redis.call("ZPOPMIN", KEYS[1])
+if #job == 0 then
+    return false
+end
+local filepart = job[1]
+local finish = tonumber(job[2])
+redis.call("SET", KEYS[3], job[2])
+local client = redis.call("HGET", KEYS[5], filepart)
+if client then
+    redis.call("HDEL", KEYS[5], filepart)
+    if (tonumber(redis.call("HGET", KEYS[2], client)) or 0) <= finish then
+        redis.call("HDEL", KEYS[2], client)
+    end
+end
+redis.call("HSET", KEYS[4], ARGV[1], filepart)
+return filepart
+""")
 
 def celery_app_init(app: Flask) -> Celery:
     class FlaskTask(Task):
@@ -26,43 +84,461 @@ def celery_app_init(app: Flask) -> Celery:
     app.extensions["celery"] = celery_app
     return celery_app
 
-@shared_task
+def enqueue_pdf(prefix, client):
+    """Queue a job behind the other jobs of the same client."""
+    keys = ["fairqueue", "fairclients", "fairweights", "fairvtime", "fairjobclient"]
+    FAIR_ENQUEUE(keys=keys, args=[os.path.basename(prefix), client])
+    process_next.delay()
+
+
+@shared_task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def process_next(self):
+    # There is one of these tasks per queued job, but which job each one
+    # runs is decided by the fair queue, not by Celery's FIFO order.
+    keys = ["fairqueue", "fairclients", "fairvtime", "fairrunning", "fairjobclient"]
+    filepart = FAIR_CLAIM(keys=keys, args=[self.request.id])
+    if filepart is None:
+        return
+
+    try:
+        process_pdf(f"{SAVELOC}/{filepart.decode('utf-8')}")
+    finally:
+        REDIS.hdel("fairrunning", self.request.id)
+
+
+@shared_task(acks_late=True, reject_on_worker_lost=True)
 def process_pdf(prefix):
     dirname = os.path.dirname(prefix)
     filepart = os.path.basename(prefix)
     if not os.path.exists(f"{prefix}.pdf"):
+        # Already finished (this is a redelivery) or cleaned up.
+        return
+    if os.path.exists(f"{prefix}-processed.pdf"):
+        # The pipeline finished, but the worker died before the bookkeeping.
+        finish_job(prefix)
+        return
+    if REDIS.exists(f"shards-{filepart}"):
+        # Already handed over to the OCR shards.
+        return
+
+    # Only one worker may run a job at a time; the lease expires if that
+    # worker dies, at which point the reaper hands the job out again.
+    if not REDIS.set(f"lease-{filepart}", WORKER_NAME, nx=True, ex=LEASE_SECS):
+        return
+
+    # A document that kills the worker (running it out of memory, say)
+    # would otherwise be retried forever.
+    attempts = REDIS.incr(f"attempts-{filepart}")
+    if attempts > MAX_ATTEMPTS:
+        REDIS.delete(f"lease-{filepart}")
+        fail_job(prefix)
         return
     REDIS.set(f"status-{filepart}", "processing")
 
     try:
-        subprocess.run(["docker", "run", "--user",
-                        f"{os.getuid()}:{os.getgid()}", "-v",
-                        f"{dirname}:/usr/pdf", "jmaslak/format-scan-pdf",
-                        "--runfile", f"{filepart}.run",
-                        f"{filepart}.pdf", f"{filepart}-processed.pdf"], shell=False, check=True)
-    except:
-        if os.path.exists(f"{prefix}.pdf"):
-            os.remove(f"{prefix}.pdf")
-        if os.path.exists(f"{prefix}.run"):
-            os.remove(f"{prefix}.run")
-        if os.path.exists(f"{prefix}-processed.pdf"):
-            os.remove(f"{prefix}-processed.pdf")
-        REDIS.set(f"after-{filepart}", 0)
-        REDIS.delete(f"after-{filepart}")
-        REDIS.set(f"status-{filepart}", "errored")
-        REDIS.pexpire(f"status-{filepart}", 3_600_000)  # one hour
-        REDIS.decr("keysqueued")
-        REDIS.pexpire(f"filename-{filepart}", 3_600_000)  # one hour
+        runfile = read_runfile(f"{prefix}.run")
+        if current_app.config["OCR_SHARDING"] and runfile.get("ocr") == "yes":
+            ranges = shard_ranges(count_pages(dirname, f"{filepart}.pdf"))
+        else:
+            ranges = []
+
+        if len(ranges) < 2:
+            # The work directory lets the pipeline skip stages that an
+            # earlier, interrupted attempt already completed.
+            run_container(dirname, f"pdf-{filepart}",
+                          ["--runfile", f"{filepart}.run", "--workdir", f"{filepart}.work",
+                           f"{filepart}.pdf", f"{filepart}-processed.pdf"],
+                          lease=f"lease-{filepart}")
+        else:
+            shard_pdf(prefix, runfile)
+    except Exception:
+        # Not a bare except: a worker shutting down (SystemExit) must leave
+        # the job's files alone, so that the redelivery resumes it.
+        fail_job(prefix)
+        raise
+    except BaseException:
+        # ...and the interruption doesn't count against the document.
+        REDIS.decr(f"attempts-{filepart}")
         raise
+    finally:
+        REDIS.delete(f"lease-{filepart}")
 
-    REDIS.set(f"after-{filepart}", 0)
-    REDIS.delete(f"after-{filepart}")
-    REDIS.set(f"status-{filepart}", "done")
-    REDIS.pexpire(f"status-{filepart}", 3_600_000)  # one hour
-    REDIS.decr("keysqueued")
-    REDIS.pexpire(f"filename-{filepart}", 3_600_000)  # one hour
+    if len(ranges) < 2:
+        finish_job(prefix)
+
+
+def shard_pdf(prefix, runfile):
+    """Run everything but OCR, then OCR the result in shards on the "ocr" queue."""
+    dirname = os.path.dirname(prefix)
+    filepart = os.path.basename(prefix)
+
+    if not os.path.exists(f"{prefix}-preocr.pdf"):
+        with open(f"{prefix}-preocr.run", "w") as out:
+            for k, v in runfile.items():
+                if k not in ("ocr", "optimize"):
+                    out.write(f"{k} {v}\n")
+            out.write("ocr no\n")
+            out.write("optimize none\n")
+        run_container(dirname, f"pdf-{filepart}",
+                      ["--runfile", f"{filepart}-preocr.run", "--workdir", f"{filepart}.work",
+                       f"{filepart}.pdf", f"{filepart}-preocr.pdf"],
+                      lease=f"lease-{filepart}")
+
+    # Page counts can change in the pipeline (splitting, removing pages).
+    ranges = shard_ranges(count_pages(dirname, f"{filepart}-preocr.pdf"))
+    for i, (first, last) in enumerate(ranges):
+        shard = f"{filepart}-shard-{i:04d}"
+        if not os.path.exists(f"{dirname}/{shard}.pdf"):
+            # Written under a temporary name, so a retry never reuses a
+            # half-written shard.
+            run_container(dirname, f"pdf-{shard}",
+                          [f"{filepart}-preocr.pdf", "--pages", f"{filepart}-preocr.pdf",
+                           f"{first}-{last}", "--", f"{shard}.pdf.tmp"],
+                          entrypoint="qpdf", ok_codes=(0, 3))
+            os.replace(f"{dirname}/{shard}.pdf.tmp", f"{dirname}/{shard}.pdf")
+
+    # Everything except OCR has already been done, so the shards only
+    # need the OCR stage (and optimization of the pages they return).
+    with open(f"{prefix}-shard.run", "w") as out:
+        out.write("remove_blank no\n")
+        out.write("remove_metadata no\n")
+        out.write("rotate none\n")
+        out.write("crop 100center\n")
+        out.write("split no\n")
+        out.write("remove_pages none\n")
+        out.write("deskew no\n")
+        out.write("ocr yes\n")
+        out.write(f"optimize {runfile.get('optimize', 'none')}\n")
+
+    # Mark the job as handed over before sending the shards: a redelivery
+    # must never send them twice.  If the worker dies in between, the
+    # reaper finds the "dispatching" marker without a lease and fails the
+    # job, as it can't know whether the shards went out.
+    REDIS.set(f"shards-{filepart}", "dispatching")
+    REDIS.set(f"shardsdeadline-{filepart}", int(time.time()) + SHARD_DEADLINE_SECS)
+    for i in range(len(ranges)):
+        ocr_shard.delay(prefix, i)
+    REDIS.set(f"shards-{filepart}", len(ranges))
+
+
+@shared_task(acks_late=True, reject_on_worker_lost=True)
+def ocr_shard(prefix, index):
+    dirname = os.path.dirname(prefix)
+    filepart = os.path.basename(prefix)
+    shard = f"{filepart}-shard-{index:04d}"
+    if not os.path.exists(f"{prefix}.pdf"):
+        # The job has finished or failed in the meantime.
+        return
+
+    if not os.path.exists(f"{dirname}/{shard}-ocr.pdf"):
+        # Shards hold leases like jobs do, so that the reaper can tell a
+        # shard whose worker died from one that is still queued.
+        if not REDIS.set(f"lease-{shard}", WORKER_NAME, nx=True, ex=LEASE_SECS):
+            return
+        attempts = REDIS.incr(f"attempts-{shard}")
+        REDIS.expire(f"attempts-{shard}", SHARD_DEADLINE_SECS)
+        try:
+            if attempts > MAX_ATTEMPTS:
+                fail_job(prefix)
+                return
+            REDIS.sadd(f"shardsstarted-{filepart}", index)
+            REDIS.expire(f"shardsstarted-{filepart}", SHARD_DEADLINE_SECS)
+            run_container(dirname, f"pdf-{shard}",
+                          ["--runfile", f"{filepart}-shard.run", "--workdir", f"{shard}.work",
+                           f"{shard}.pdf", f"{shard}-ocr.pdf"],
+                          lease=f"lease-{shard}")
+        except Exception:
+            fail_job(prefix)
+            raise
+        except BaseException:
+            REDIS.decr(f"attempts-{shard}")
+            raise
+        finally:
+            REDIS.delete(f"lease-{shard}")
+
+    shard_done(prefix, index)
+
+
+def shard_done(prefix, index):
+    """Record a finished shard, and merge the job once all of them are."""
+    filepart = os.path.basename(prefix)
+    if not os.path.exists(f"{prefix}.pdf"):
+        return
+    shards = REDIS.get(f"shards-{filepart}")
+    if shards is None or not shards.isdigit():
+        return
+
+    # Only the shard that completes the set sends the merge.
+    if REDIS.sadd(f"shardsdone-{filepart}", index):
+        REDIS.expire(f"shardsdone-{filepart}", SHARD_DEADLINE_SECS)
+        if REDIS.scard(f"shardsdone-{filepart}") == int(shards):
+            merge_shards.delay(prefix)
+
+
+@shared_task(acks_late=True, reject_on_worker_lost=True)
+def merge_shards(prefix):
+    dirname = os.path.dirname(prefix)
+    filepart = os.path.basename(prefix)
+    if not os.path.exists(f"{prefix}.pdf"):
+        return
+    if not REDIS.set(f"lease-{filepart}", WORKER_NAME, nx=True, ex=LEASE_SECS):
+        # Another worker is already merging.
+        return
+    # Tells the reaper to send the merge again if this worker dies.
+    REDIS.set(f"shardsmerging-{filepart}", 1)
+
+    try:
+        count = int(REDIS.get(f"shards-{filepart}"))
+        shards = [f"{filepart}-shard-{i:04d}-ocr.pdf" for i in range(count)]
+        # Document-level data (metadata, linearization) comes from the
+        # pre-OCR file, which has already been through the metadata step;
+        # only the pages (with their text layers) come from the shards.
+        args = [f"{filepart}-preocr.pdf", "--pages"]
+        for shard in shards:
+            args += [shard, "1-z"]
+        args += ["--", f"{filepart}-processed.pdf.partial"]
+        runfile = read_runfile(f"{prefix}.run")
+        if runfile.get("remove_metadata") == "yes":
+            args.insert(0, "--linearize")
+        if runfile.get("optimize", "none") != "none":
+            args.insert(0, "--object-streams=generate")
+
+        # qpdf exits with 3 on warnings, which are not fatal.
+        run_container(dirname, f"pdf-{filepart}", args, lease=f"lease-{filepart}",
+                      entrypoint="qpdf", ok_codes=(0, 3))
+        os.replace(f"{prefix}-processed.pdf.partial", f"{prefix}-processed.pdf")
+    except Exception:
+        fail_job(prefix)
+        raise
+    finally:
+        REDIS.delete(f"lease-{filepart}")
+
+    finish_job(prefix)
 
+
+def read_runfile(fn):
+    """Read a run file into a dict (like format-scan-pdf.py does)."""
+    runfile = {}
+    with open(fn, "r") as f:
+        for line in f:
+            eles = line.strip().lower().split(" ", 1)
+            if len(eles) == 2:
+                runfile[eles[0]] = eles[1]
+    return runfile
+
+
+def shard_ranges(pages):
+    """Split a document into page ranges, one per OCR shard."""
+    shards = max(1, min(OCR_MAX_SHARDS, pages // OCR_SHARD_PAGES))
+    size = -(-pages // shards)  # Round up
+    return [(first, min(first + size - 1, pages)) for first in range(1, pages + 1, size)]
+
+
+def count_pages(dirname, fn):
+    """Number of pages in a PDF in dirname."""
+    output = subprocess.check_output(["docker", "run", "--rm", "--user",
+                                      f"{os.getuid()}:{os.getgid()}", "-v",
+                                      f"{dirname}:/usr/pdf", "--entrypoint", "qpdf",
+                                      DOCKER_IMAGE, "--show-npages", fn], shell=False)
+    return int(output.decode("utf-8").strip())
+
+
+def run_container(dirname, name, args, lease=None, entrypoint=None, ok_codes=(0,)):
+    """Run the image on files in dirname, renewing a job lease while it runs."""
+    # The container outlives a killed worker, so get rid of any leftover
+    # from a previous attempt before starting again.
+    subprocess.run(["docker", "rm", "-f", name],
+                   shell=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    cmd = ["docker", "run", "--rm", "--name", name, "--user",
+           f"{os.getuid()}:{os.getgid()}", "-v", f"{dirname}:/usr/pdf"]
+    if entrypoint is not None:
+        cmd += ["--entrypoint", entrypoint]
+    cmd += [DOCKER_IMAGE] + args
+
+    proc = subprocess.Popen(cmd, shell=False)
+    while True:
+        try:
+            returncode = proc.wait(timeout=LEASE_SECS / 5)
+            break
+        except subprocess.TimeoutExpired:
+            if lease is not None:
+                REDIS.expire(lease, LEASE_SECS)
+
+    if returncode not in ok_codes:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+
+def remove_job_files(prefix):
+    """Remove the input files and scratch space of a job."""
     if os.path.exists(f"{prefix}.pdf"):
         os.remove(f"{prefix}.pdf")
     if os.path.exists(f"{prefix}.run"):
         os.remove(f"{prefix}.run")
+    if os.path.exists(f"{prefix}-processed.pdf.partial"):
+        os.remove(f"{prefix}-processed.pdf.partial")
+    shutil.rmtree(f"{prefix}.work", ignore_errors=True)
+
+    for fn in glob.glob(f"{prefix}-preocr.*") + glob.glob(f"{prefix}-shard*"):
+        if os.path.isdir(fn):
+            shutil.rmtree(fn, ignore_errors=True)
+        else:
+            os.remove(fn)
+
+
+def release_fair_claim(filepart):
+    """Forget which process_next task runs a job (so it no longer counts
+    as running in the queue positions shown to waiting clients)."""
+    for task_id, claimed in REDIS.hgetall("fairrunning").items():
+        if claimed.decode("utf-8") == filepart:
+            REDIS.hdel("fairrunning", task_id)
+
+
+def delete_job_keys(filepart):
+    """Remove the Redis keys that track a job while it runs."""
+    REDIS.delete(f"attempts-{filepart}", f"shards-{filepart}", f"shardsdeadline-{filepart}",
+                 f"shardsstarted-{filepart}", f"shardsdone-{filepart}",
+                 f"shardsmerging-{filepart}")
+
+
+def finish_job(prefix):
+    """Mark a job as done.  Safe to call more than once."""
+    filepart = os.path.basename(prefix)
+
+    REDIS.set(f"status-{filepart}", "done")
+    REDIS.pexpire(f"status-{filepart}", 3_600_000)  # one hour
+    REDIS.srem("queuedkeys", filepart)
+    REDIS.zrem("fairqueue", filepart)
+    REDIS.hdel("fairjobclient", filepart)
+    delete_job_keys(filepart)
+    release_fair_claim(filepart)
+    REDIS.pexpire(f"filename-{filepart}", 3_600_000)  # one hour
+
+    remove_job_files(prefix)
+
+
+def fail_job(prefix):
+    """Mark a job as errored.  Safe to call more than once."""
+    filepart = os.path.basename(prefix)
+
+    remove_job_files(prefix)
+    if os.path.exists(f"{prefix}-processed.pdf"):
+        os.remove(f"{prefix}-processed.pdf")
+
+    REDIS.set(f"status-{filepart}", "errored")
+    REDIS.pexpire(f"status-{filepart}", 3_600_000)  # one hour
+    REDIS.srem("queuedkeys", filepart)
+    REDIS.zrem("fairqueue", filepart)
+    REDIS.hdel("fairjobclient", filepart)
+    delete_job_keys(filepart)
+    release_fair_claim(filepart)
+    REDIS.pexpire(f"filename-{filepart}", 3_600_000)  # one hour
+
+
+def reap(dead_worker=None):
+    """Reconcile the job state in Redis with the files in SAVELOC.
+
+    Leases held by dead_worker (a worker that is starting up, and so
+    cannot be running anything) are treated as expired."""
+    for member in REDIS.smembers("queuedkeys"):
+        filepart = member.decode("utf-8")
+        prefix = f"{SAVELOC}/{filepart}"
+
+        if not os.path.exists(f"{prefix}.pdf"):
+            # The worker got as far as producing the output (or lost the
+            # input) but died before doing the bookkeeping.
+            if os.path.exists(f"{prefix}-processed.pdf"):
+                finish_job(prefix)
+            else:
+                fail_job(prefix)
+            continue
+
+        lease = get_lease(f"lease-{filepart}", dead_worker)
+        shards = REDIS.get(f"shards-{filepart}")
+        if shards == b"dispatching" and lease is None:
+            # The worker died while sending the shards.
+            fail_job(prefix)
+            continue
+        if shards is not None and shards.isdigit():
+            reap_shards(prefix, int(shards), lease, dead_worker)
+            continue
+
+        status = REDIS.get(f"status-{filepart}")
+        if status == b"processing" and lease is None and shards is None:
+            # The worker died mid-job.  Its message will eventually be
+            # redelivered too, but there is no reason to wait for that.
+            release_fair_claim(filepart)
+            process_pdf.delay(prefix)
+
+    # Claims of process_next tasks whose job is long gone.
+    for task_id, claimed in REDIS.hgetall("fairrunning").items():
+        if not REDIS.sismember("queuedkeys", claimed):
+            REDIS.hdel("fairrunning", task_id)
+
+    # Uploads that never made it into the queue, and scratch space left
+    # behind by jobs that no longer exist.
+    cutoff = time.time() - ORPHAN_SECS
+    for fn in glob.glob(f"{SAVELOC}/web-*"):
+        match = re.match(r"^(web-[A-Za-z0-9_-]{86})", os.path.basename(fn))
+        if match is None or os.path.getmtime(fn) > cutoff:
+            continue
+        if not REDIS.sismember("queuedkeys", match.group(1)):
+            remove_job_files(f"{SAVELOC}/{match.group(1)}")
+
+
+def get_lease(key, dead_worker):
+    """The owner of a lease, or None if it has expired (or is held by
+    dead_worker, in which case it is removed)."""
+    lease = REDIS.get(key)
+    if lease is not None and dead_worker is not None and lease.decode("utf-8") == dead_worker:
+        REDIS.delete(key)
+        lease = None
+    return lease
+
+
+def reap_shards(prefix, count, lease, dead_worker):
+    """Reconcile a job that has been handed over to OCR shards."""
+    dirname = os.path.dirname(prefix)
+    filepart = os.path.basename(prefix)
+
+    if lease is None and REDIS.delete(f"shardsmerging-{filepart}"):
+        # The worker died while merging.
+        merge_shards.delay(prefix)
+        return
+
+    shard_leases = 0
+    for i in range(count):
+        shard = f"{filepart}-shard-{i:04d}"
+        if os.path.exists(f"{dirname}/{shard}-ocr.pdf"):
+            # Its worker may have died between finishing and recording it.
+            shard_done(prefix, i)
+        elif get_lease(f"lease-{shard}", dead_worker) is not None:
+            shard_leases += 1
+        elif REDIS.srem(f"shardsstarted-{filepart}", i):
+            # Started, but its worker died.  The original message only
+            # comes back once the broker's visibility timeout runs out.
+            ocr_shard.delay(prefix, i)
+
+    # Shards that are merely queued are left alone, however long that
+    # takes, up to a deadline that also catches lost messages.
+    deadline = int(REDIS.get(f"shardsdeadline-{filepart}") or 0)
+    if lease is None and shard_leases == 0 and time.time() > deadline:
+        fail_job(prefix)
+
+
+@shared_task
+def reap_jobs():
+    reap()
+
+
+@celeryd_init.connect
+def set_worker_name(sender, **kwargs):
+    # Runs before the pool starts, so the pool processes inherit it.
+    global WORKER_NAME
+    WORKER_NAME = sender
+
+
+@worker_ready.connect
+def reap_on_start(sender, **kwargs):
+    # Anything this worker held a lease on died with its previous run.
+    reap(dead_worker=WORKER_NAME)